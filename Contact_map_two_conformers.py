@@ -8,34 +8,99 @@ Overview:
     The script uses several libraries to handle trajectory data, perform contact map calculations, and visualize the results.
 
 Dependencies:
-    - matplotlib: For plotting graphs and contact maps.
+    - matplotlib: For plotting graphs and contact maps (non-interactive Agg backend when run
+      as a script).
     - mdtraj: For loading and handling molecular dynamics trajectories.
-    - contact_map: For calculating contact frequencies and differences.
-    - networkx: For graph operations and subgraph extraction.
+    - contact_map: For calculating contact frequencies.
+    - numpy: For residue label lookups.
+    - numba: For counting residue contacts over the frames of large trajectories.
+    - scipy: For the sparse adjacency matrices holding the residue contact maps and their
+      difference, and for KD-tree contact search.
+    - networkx: For drawing the residue contact subgraphs.
+    - joblib: For extracting the residue subgraphs of both structures in parallel.
+    - orjson: For writing the contact map JSON files straight from NumPy arrays.
     - argparse: For parsing command-line arguments.
+    - concurrent.futures: For computing the two contact maps in parallel.
+
+    matplotlib and networkx are imported inside the functions that plot, and numba inside
+    contact_counter_kernel, so importing this module (e.g. for residue_contacts) does not
+    load them or change the matplotlib backend.
 
 Functions:
-    - find_contacts(trajectoryA, trajectoryB, filenameA, filenameB, cut_off):
-        Calculates contact frequencies for two trajectories using a specified cutoff distance.
-        Plots contact maps for each trajectory and calculates the difference between them.
-        Returns two graphs representing the contact maps.
+    - single_frame_contacts(trajectory, cut_off):
+        Computes residue contacts of a single-frame trajectory from a KD-tree query over its
+        non-water heavy atoms (including ligands), without building a ContactFrequency.
+
+    - contact_counter_kernel():
+        Imports numba and returns the (cached) kernel count_residue_contacts, which adds one
+        frame's atom contact pairs to a residue x residue count matrix, counting each residue
+        pair at most once per frame.
+
+    - multi_frame_contacts(trajectory, cut_off):
+        Computes residue contact frequencies of a multi-frame trajectory from a KD-tree query
+        over its non-water heavy atoms in each frame, counted with count_residue_contacts.
+
+    - residue_contacts(trajectory, cut_off):
+        Returns the residue contact counts of a trajectory, using single_frame_contacts
+        for single PDB structures, multi_frame_contacts for large trajectories and
+        contact_map's ContactFrequency otherwise, together with that ContactFrequency
+        (None when it was not computed).
+
+    - most_common_differences(diff, n=10):
+        Returns the n residue pairs with the largest absolute change in a contact difference matrix.
+
+    - rasterize_contact_map(ax):
+        Rasterizes the contact map artists of an axes so vector outputs embed a bitmap
+        instead of one path per contact.
+
+    - find_contacts(trajectoryA, trajectoryB, filenameA, filenameB, cut_off, eps=False):
+        Checks that both trajectories have the same residue labels (raising ValueError otherwise)
+        and calculates contact frequencies for them using a specified cutoff distance,
+        computing multi-frame trajectories in parallel worker processes.
+        Plots contact maps for each trajectory and plots the difference between their adjacency
+        matrices.
+        Returns two sparse CSR adjacency matrices (residue x residue) representing the contact maps,
+        and the ten residue label pairs whose contacts changed the most, with their change.
+
+    - contact_adjacency(contacts, n_residues):
+        Converts residue contact counts into a CSR adjacency matrix indexed by residue index.
 
-    - plot_contact_map(contacts, filename):
-        Saves the contact map data to a JSON file and plots the contact map, saving it in PDF and EPS formats.
+    - quantize_contacts(matrix):
+        Scales contact frequencies (0-1) of a sparse matrix to uint8 values (0-255).
 
-    - extract_subgraph_for_residue(target_residue, graph):
-        Extracts a subgraph from a contact map graph for a specified residue.
+    - save_contacts(contacts, frequency, filename):
+        Pickles the residue contact counts and, when one was computed, saves the atom-level
+        ContactFrequency with its save_to_file method.
 
-    - plot_multiple_contact_graphs(graph_dict, title_prefix="Subgraph for", cols=3, fname_prefix="subgraph"):
-        Plots multiple subgraphs in a grid layout and saves the combined plot as a PNG file.
+    - plot_contact_map(adjacency, filename, fig, ax, cax, eps=False):
+        Saves the quantized adjacency matrix to a JSON file and plots the quantized contact map
+        on the given (reused) figure, axes and colorbar axes, saving it in PDF format (and EPS
+        format when eps is True).
+
+    - residue_labels(topology):
+        Builds the residue labels (e.g. LYS171) of a topology as a NumPy string array.
+
+    - extract_subgraph_for_residue(center, adjacency):
+        Extracts the contact neighbourhood of the residue with index center from a CSR
+        adjacency matrix. Returns the residue index and the indices of its neighbours.
+        When several residues share a requested label (e.g. one per chain), the first
+        residue with that label is used.
+
+    - plot_multiple_contact_network_graphs(graph_dict, adjacency, labels, title_prefix="Subgraph for", cols=3, fname_prefix="subgraph"):
+        Converts each residue neighbourhood (the residue, its neighbours and all contacts among
+        them, not only those with the residue) to a networkx graph, plots them in a grid layout
+        with the target residue at the centre of a shell layout,
+        and saves the combined plot as a PNG file.
 
 Usage:
     The script is executed from the command line with the following arguments:
-    python script.py <pdbA_file> <pdbB_file> <cut_off>
+    python script.py <pdbA_file> <pdbB_file> <cut_off> [--eps] [--residue_indices ...]
 
     - <pdbA_file>: Path to the first PDB file.
     - <pdbB_file>: Path to the second PDB file.
     - <cut_off>: Cutoff distance for contact calculation (default is 0.35).
+    - --eps: Also save the contact map plots in EPS format.
+    - --residue_indices: Residues (e.g. LYS171) whose contact subgraphs are plotted.
 
 Example:
     python script.py proteinA.pdb proteinB.pdb 0.35
@@ -44,110 +109,259 @@ Example:
 
 Output:
     The script generates several output files, including:
-    - Contact map plots in PDF and EPS formats.
-    - JSON files containing contact map data.
+    - Contact map plots in PDF format (and EPS format with --eps).
+    - JSON files containing the residue contacts in COO form: "row" and "col" residue indices
+      (upper triangle) and "val" contact frequencies scaled to 0-255.
+    - <name>_residue_contacts.p: pickled residue-level contact_map ContactCount (load with pickle).
+    - <name>_contacts.p: atom-level ContactFrequency (load with ContactFrequency.from_file), only
+      written for multi-frame input analysed with ContactFrequency.
     - PNG files of combined subgraph plots.
+    The ten residue pairs whose contact frequency changed the most are printed to stdout.
 """
 
-import matplotlib.pyplot as plt
+import numpy as np
+import scipy.sparse
+from scipy.spatial import cKDTree
 import mdtraj as md
 import contact_map as cm
-import networkx as nx
+from joblib import Parallel, delayed
+import orjson
 import argparse
+import functools
+import pickle
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+# Atoms searched for contacts; the same selection contact_map's ContactFrequency uses by default.
+CONTACT_ATOMS = "not water and symbol != 'H'"
+
+# Above this many frames x residue pairs, multi-frame contacts are counted with numba.
+NUMBA_CONTACTS_THRESHOLD = 10**6
+
+def single_frame_contacts(trajectory, cut_off):
+    topology = trajectory.topology
+    atoms = topology.select(CONTACT_ATOMS)
+    atom_residues = np.array([topology.atom(i).residue.index for i in atoms])
+    atom_pairs = cKDTree(trajectory.xyz[0, atoms]).query_pairs(cut_off, output_type='ndarray')
+    residue_pairs = np.sort(atom_residues[atom_pairs], axis=1)
+    # Like ContactFrequency (n_neighbors_ignored=2), ignore residues fewer than three apart in sequence.
+    residue_pairs = residue_pairs[residue_pairs[:, 1] - residue_pairs[:, 0] > 2]
+    contact_pairs = np.unique(residue_pairs, axis=0)
+    counter = Counter({frozenset(pair): 1.0 for pair in contact_pairs.tolist()})
+    n_residues = topology.n_residues
+    return cm.ContactCount(counter, topology.residue, n_residues, n_residues)
+
+@functools.lru_cache(maxsize=None)
+def contact_counter_kernel():
+    # numba is only needed for large trajectories, so it is imported and the kernel compiled on first use.
+    import numba
 
-def find_contacts(trajectoryA, trajectoryB, filenameA, filenameB, cut_off):
-    trajA_contacts = cm.ContactFrequency(trajectoryA, cutoff=cut_off)
-    trajB_contacts = cm.ContactFrequency(trajectoryB, cutoff=cut_off)
-    plot_contact_map(trajA_contacts, filenameA)
-    plot_contact_map(trajB_contacts, filenameB)
-    diff = cm.AtomMismatchedContactDifference(trajB_contacts, trajA_contacts)
-    fig3, ax3 = diff.residue_contacts.plot(figsize=(6, 6), dpi=300)
-    plt.xlabel("Residue")
-    plt.ylabel("Residue")
-    fig3.savefig(f"diff_contacts_{filenameA}_{filenameB}.pdf")
-    fig3.savefig(f"diff_contacts_{filenameA}_{filenameB}.eps")
-    diff.residue_contacts.most_common()[:10]
-    graphA = trajA_contacts.residue_contacts.to_networkx()
-    graphB = trajB_contacts.residue_contacts.to_networkx()
-    return graphA, graphB
-
-def plot_contact_map(contacts, filename):
-    json_str = contacts.to_json()
-    from_json_str = cm.ContactFrequency.from_json(json_str)
-    dict = from_json_str.to_json()
-    with open(f"sample_{filename}.json", "w") as outfile:
-        outfile.write(dict)
-    figA, axA = contacts.residue_contacts.plot(figsize=(6, 6), dpi=300)
-    plt.xlabel("Residue")
-    plt.ylabel("Residue")
-    figA.savefig(f"{filename}_contacts.pdf")
-    figA.savefig(f"{filename}_contacts.eps")
-    contacts.save_to_file(f"{filename}_contacts.p")
-
-def extract_subgraph_for_residue(target_residue, graph):
-    target_node = target_residue
-    for node in graph:
-        node_seq = node.resSeq
-        node_name = node.name
-        node_label = node_name + str(node_seq)
-        if target_node == node_label:
-            target_node = node
-            break
-    if target_node in graph:
-        new_graph = nx.Graph()
-        new_graph.add_node(target_node)
-        for node in graph.nodes():
-            if graph.has_edge(target_node, node):
-                new_graph.add_edge(target_node, node)
-                new_graph.add_node(node)
-        return new_graph
-    return None
-
-def plot_multiple_contact_network_graphs(graph_dict, title_prefix="Subgraph for", cols=3, fname_prefix="subgraph"):
+    @numba.njit
+    def count_residue_contacts(frame, atom_pairs, atom_residues, residue_ids, counts, last_frame):
+        for k in range(atom_pairs.shape[0]):
+            i = atom_residues[atom_pairs[k, 0]]
+            j = atom_residues[atom_pairs[k, 1]]
+            if i > j:
+                i, j = j, i
+            # Count each residue pair once per frame, ignoring residues fewer than three apart in sequence.
+            if residue_ids[j] - residue_ids[i] > 2 and last_frame[i, j] != frame:
+                last_frame[i, j] = frame
+                counts[i, j] += 1
+
+    return count_residue_contacts
+
+def multi_frame_contacts(trajectory, cut_off):
+    topology = trajectory.topology
+    atoms = topology.select(CONTACT_ATOMS)
+    # Residues are renumbered compactly so the count matrices only cover residues with contact atoms.
+    residue_ids, atom_residues = np.unique(np.array([topology.atom(i).residue.index for i in atoms], dtype=int),
+                                            return_inverse=True)
+    count_residue_contacts = contact_counter_kernel()
+    counts = np.zeros((len(residue_ids), len(residue_ids)), dtype=np.int32)
+    last_frame = np.full(counts.shape, -1, dtype=np.int32)
+    for frame in range(trajectory.n_frames):
+        atom_pairs = cKDTree(trajectory.xyz[frame, atoms]).query_pairs(cut_off, output_type='ndarray')
+        count_residue_contacts(frame, atom_pairs, atom_residues, residue_ids, counts, last_frame)
+    first, second = np.nonzero(counts)
+    frequencies = counts[first, second] / trajectory.n_frames
+    counter = Counter({frozenset((residue_ids[i], residue_ids[j])): frequency for i, j, frequency
+                       in zip(first.tolist(), second.tolist(), frequencies.tolist())})
+    n_residues = topology.n_residues
+    return cm.ContactCount(counter, topology.residue, n_residues, n_residues)
+
+def residue_contacts(trajectory, cut_off):
+    if trajectory.n_frames == 1:
+        return single_frame_contacts(trajectory, cut_off), None
+    n_residues = trajectory.topology.n_residues
+    if trajectory.n_frames * n_residues * (n_residues - 1) // 2 > NUMBA_CONTACTS_THRESHOLD:
+        return multi_frame_contacts(trajectory, cut_off), None
+    frequency = cm.ContactFrequency(trajectory, cutoff=cut_off)
+    return frequency.residue_contacts, frequency
+
+def contact_adjacency(contacts, n_residues):
+    adjacency = contacts.sparse_matrix.tocsr()
+    adjacency.resize((n_residues, n_residues))
+    return adjacency
+
+def most_common_differences(diff, n=10):
+    # The difference matrix is symmetric, so rank each residue pair once.
+    upper = scipy.sparse.triu(diff, k=1).tocoo()
+    order = np.argsort(-np.abs(upper.data))[:n]
+    return [((upper.row[k], upper.col[k]), upper.data[k]) for k in order]
+
+def rasterize_contact_map(ax):
+    for artist in (*ax.images, *ax.collections):
+        artist.set_rasterized(True)
+
+def find_contacts(trajectoryA, trajectoryB, filenameA, filenameB, cut_off, eps=False):
+    import matplotlib.pyplot as plt
+    # The contact maps are compared residue index by residue index, which is only meaningful
+    # for structures of the same protein.
+    labels = residue_labels(trajectoryA.topology)
+    if not np.array_equal(labels, residue_labels(trajectoryB.topology)):
+        raise ValueError(f"{filenameA} and {filenameB} do not have the same residues in the same order; "
+                         "their contact maps cannot be compared")
+    if trajectoryA.n_frames == 1 and trajectoryB.n_frames == 1:
+        # Single structures take milliseconds; a process pool would only add pickling and start-up cost.
+        results = [residue_contacts(trajectory, cut_off) for trajectory in (trajectoryA, trajectoryB)]
+    else:
+        # The two contact maps are independent, so build them in separate processes.
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(residue_contacts, trajectory, cut_off)
+                       for trajectory in (trajectoryA, trajectoryB)]
+            results = [f.result() for f in futures]
+    (trajA_contacts, trajA_frequency), (trajB_contacts, trajB_frequency) = results
+    save_contacts(trajA_contacts, trajA_frequency, filenameA)
+    save_contacts(trajB_contacts, trajB_frequency, filenameB)
+    # sparse_matrix is rebuilt from the contact counter on every access, so convert it once
+    # and share the CSR matrix between plotting, JSON output, the difference and subgraphs.
+    n_residues = len(labels)
+    adjacencyA = contact_adjacency(trajA_contacts, n_residues)
+    adjacencyB = contact_adjacency(trajB_contacts, n_residues)
+    # One figure is shared by both contact maps and their difference; each plot clears it.
+    fig, (ax, cax) = plt.subplots(1, 2, figsize=(6, 6), dpi=300, gridspec_kw={"width_ratios": [20, 1]})
+    plot_contact_map(adjacencyA, filenameA, fig, ax, cax, eps)
+    plot_contact_map(adjacencyB, filenameB, fig, ax, cax, eps)
+    diff = adjacencyB - adjacencyA
+    ax.cla()
+    cax.cla()
+    diff_image = ax.imshow(diff.toarray(), cmap='seismic', vmin=-1.0, vmax=1.0, origin='lower')
+    fig.colorbar(diff_image, cax=cax)
+    ax.set_xlabel("Residue")
+    ax.set_ylabel("Residue")
+    rasterize_contact_map(ax)
+    fig.savefig(f"diff_contacts_{filenameA}_{filenameB}.pdf")
+    if eps:
+        fig.savefig(f"diff_contacts_{filenameA}_{filenameB}.eps")
+    plt.close(fig)
+    top_differences = [((labels[i], labels[j]), value) for (i, j), value in most_common_differences(diff)]
+    return adjacencyA, adjacencyB, top_differences
+
+def quantize_contacts(matrix):
+    quantized = matrix.tocsr(copy=True)
+    quantized.data = np.rint(quantized.data * 255).astype(np.uint8)
+    return quantized
+
+def save_contacts(contacts, frequency, filename):
+    with open(f"{filename}_residue_contacts.p", "wb") as outfile:
+        pickle.dump(contacts, outfile)
+    if frequency is not None:
+        frequency.save_to_file(f"{filename}_contacts.p")
+
+def plot_contact_map(adjacency, filename, fig, ax, cax, eps=False):
+    quantized = quantize_contacts(adjacency)
+    upper = scipy.sparse.triu(quantized, k=1).tocoo()
+    with open(f"sample_{filename}.json", "wb") as outfile:
+        outfile.write(orjson.dumps({"row": upper.row, "col": upper.col, "val": upper.data},
+                                   option=orjson.OPT_SERIALIZE_NUMPY))
+    ax.cla()
+    cax.cla()
+    image = ax.imshow(quantized.toarray(), cmap='viridis', vmin=0, vmax=255, origin='lower')
+    fig.colorbar(image, cax=cax, label="Contact frequency (0-255)")
+    ax.set_xlabel("Residue")
+    ax.set_ylabel("Residue")
+    rasterize_contact_map(ax)
+    fig.savefig(f"{filename}_contacts.pdf")
+    if eps:
+        fig.savefig(f"{filename}_contacts.eps")
+
+def residue_labels(topology):
+    names = np.array([res.name for res in topology.residues])
+    seqs = np.array([res.resSeq for res in topology.residues])
+    return np.char.add(names, seqs.astype(str))
+
+def extract_subgraph_for_residue(center, adjacency):
+    neighbors = adjacency.indices[adjacency.indptr[center]:adjacency.indptr[center + 1]]
+    if neighbors.size == 0:
+        return None
+    return center, neighbors
+
+def plot_multiple_contact_network_graphs(graph_dict, adjacency, labels, title_prefix="Subgraph for", cols=3, fname_prefix="subgraph"):
+    import matplotlib.pyplot as plt
+    import networkx as nx
     num_graphs = len(graph_dict)
     rows = (num_graphs + cols - 1) // cols
     fig, axes = plt.subplots(rows, cols, figsize=(cols * 4, rows * 4))
     axes = axes.flatten()
-    for i, (res_label, graph) in enumerate(graph_dict.items()):
+    for i, (res_label, (center, neighbors)) in enumerate(graph_dict.items()):
         ax = axes[i]
-        pos = nx.spring_layout(graph)
-        nx.draw(graph, pos, ax=ax, with_labels=True,
+        nodes = [center, *neighbors]
+        # Nodes stay positions in nodes, since residues on different chains can share a label.
+        graph = nx.from_scipy_sparse_array(adjacency[np.ix_(nodes, nodes)])
+        node_labels = {k: labels[node] for k, node in enumerate(nodes)}
+        # The subgraph holds the target residue, its neighbours and the contacts among them;
+        # put the target at the centre of a shell instead of running a force-directed layout.
+        pos = nx.shell_layout(graph, nlist=[[0], list(range(1, len(nodes)))])
+        nx.draw(graph, pos, ax=ax, with_labels=True, labels=node_labels,
                 node_size=500, node_color='skyblue', font_size=10, edge_color='gray')
         ax.set_title(f"{title_prefix} {res_label}")
     for j in range(i + 1, len(axes)):
         axes[j].axis('off')
     plt.tight_layout()
-    plt.savefig(f"{fname_prefix}_combined.png")
-    plt.show()
+    fig.savefig(f"{fname_prefix}_combined.png")
+    plt.close(fig)
 
 if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')
     parser = argparse.ArgumentParser(description="Perform contact_map analysis")
     parser.add_argument("pdbA_file", help="Path to the PDB file 1")
     parser.add_argument("pdbB_file", help="Path to the PDB_file 2")
     parser.add_argument("cut_off", type=float, default=0.35, help="Cutoff for distance. default is 0.35")
+    parser.add_argument("--eps", action="store_true", help="Also save the contact maps in EPS format")
     parser.add_argument("--residue_indices", nargs='*', help="A list of residues code with indexes to be analyzed for example: LYS171")
     args = parser.parse_args()
 
-    trajA = md.load(args.pdbA_file, top=args.pdbA_file)
-    trajB = md.load(args.pdbB_file, top=args.pdbB_file)
+    trajA = md.load_pdb(args.pdbA_file)
+    trajB = md.load_pdb(args.pdbB_file)
     cut_off = args.cut_off
     residues_list = args.residue_indices if args.residue_indices is not None else ["LYS171", "HIS201", "TYR202", "LEU203", "GLY204", "LYS205", "GLU239", "ASP258", "GLN395", "KHB360"] # Example default indices
 
     filenameA = f"{'.'.join(args.pdbA_file.split('.')[:-1])}"
     filenameB = f"{'.'.join(args.pdbB_file.split('.')[:-1])}"
     
-    graphA, graphB = find_contacts(trajA, trajB, filenameA, filenameB, cut_off)
-
-    
+    adjacencyA, adjacencyB, top_differences = find_contacts(trajA, trajB, filenameA, filenameB, cut_off, args.eps)
+    for (residue_i, residue_j), change in top_differences:
+        print(f"{residue_i}-{residue_j}: {change:+.2f}")
+    # find_contacts has checked that both structures have the same residue labels, so one
+    # label lookup serves both. A label shared by several residues (e.g. the same residue on
+    # each chain of a homodimer) selects the first of them.
+    labels = residue_labels(trajA.topology)
+    targets = {}
+    for i in np.flatnonzero(np.isin(labels, residues_list)):
+        targets.setdefault(labels[i], i)
 
     subgraphs_A = {}
     subgraphs_B = {}
+    tasks = []
     for res in residues_list:
-        subgraphA = extract_subgraph_for_residue(res, graphA)
-        subgraphB = extract_subgraph_for_residue(res, graphB)
-        if subgraphA:
-            subgraphs_A[res] = subgraphA
-        if subgraphB:
-            subgraphs_B[res] = subgraphB
-    plot_multiple_contact_network_graphs(subgraphs_A, fname_prefix=filenameA)
-    plot_multiple_contact_network_graphs(subgraphs_B, fname_prefix=filenameB)
+        if res in targets:
+            tasks.append((res, subgraphs_A, targets[res], adjacencyA))
+            tasks.append((res, subgraphs_B, targets[res], adjacencyB))
+    results = Parallel(n_jobs=-1, backend='threading')(
+        delayed(extract_subgraph_for_residue)(center, adjacency) for _, _, center, adjacency in tasks)
+    for (res, subgraphs, _, _), subgraph in zip(tasks, results):
+        if subgraph is not None:
+            subgraphs[res] = subgraph
+    plot_multiple_contact_network_graphs(subgraphs_A, adjacencyA, labels, fname_prefix=filenameA)
+    plot_multiple_contact_network_graphs(subgraphs_B, adjacencyB, labels, fname_prefix=filenameB)
@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+md = pytest.importorskip("mdtraj")
+cm = pytest.importorskip("contact_map")
+pytest.importorskip("numba")
+pytest.importorskip("scipy")
+pytest.importorskip("joblib")
+pytest.importorskip("orjson")
+
+import Contact_map_two_conformers as pcmn
+
+CUT_OFF = 0.45
+
+
+def tiny_trajectory(n_frames=6, n_residues=10, seed=0):
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for index in range(n_residues):
+        residue = topology.add_residue("ALA", chain, resSeq=index + 1)
+        topology.add_atom("CA", md.element.carbon, residue)
+        topology.add_atom("CB", md.element.carbon, residue)
+        topology.add_atom("HA", md.element.hydrogen, residue)
+    rng = np.random.default_rng(seed)
+    xyz = rng.uniform(0.0, 1.2, size=(n_frames, topology.n_atoms, 3)).astype(np.float32)
+    return md.Trajectory(xyz, topology)
+
+
+def index_frequencies(contacts):
+    return {frozenset(residue.index for residue in pair): value
+            for pair, value in contacts.counter.items()}
+
+
+def assert_same_contacts(contacts, expected):
+    contacts = index_frequencies(contacts)
+    expected = index_frequencies(expected)
+    assert contacts.keys() == expected.keys()
+    for pair, value in expected.items():
+        assert contacts[pair] == pytest.approx(value)
+
+
+def test_single_frame_contacts_match_contact_frequency():
+    trajectory = tiny_trajectory(n_frames=1)
+    expected = cm.ContactFrequency(trajectory, cutoff=CUT_OFF).residue_contacts
+    assert_same_contacts(pcmn.single_frame_contacts(trajectory, CUT_OFF), expected)
+
+
+def test_multi_frame_contacts_match_contact_frequency():
+    trajectory = tiny_trajectory()
+    expected = cm.ContactFrequency(trajectory, cutoff=CUT_OFF).residue_contacts
+    assert_same_contacts(pcmn.multi_frame_contacts(trajectory, CUT_OFF), expected)